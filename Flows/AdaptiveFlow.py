@@ -1,36 +1,71 @@
+import logging
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 
-from langchain import hub
-from langchain_community.tools import TavilySearchResults
-from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.constants import START, END
 from langgraph.graph import StateGraph
 
+from Handlers.LLMHandler import get_hub_prompt, get_llm
+from Handlers.SemanticCache import SemanticCache
+from Handlers.StreamHandler import stream_generation
+from Handlers.WebSearchHandler import docs_to_document, run_web_search
 from States.AdaptiveState import AdaptiveState
-from Models.RotueQuery import RouteQuery
+from Models.RouteQueryWithConfidence import RouteQueryWithConfidence
 from SelfFlow import SelfFlow
 
 
+log = logging.getLogger(__name__)
+
 class AdaptiveFlow:
 
     def __init__(self, self_flow: SelfFlow):
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            api_key=os.getenv("GEMINI_API_KEY")
-        )
+        self.llm = get_llm("gemini-2.0-flash", os.getenv("GEMINI_API_KEY"))
         self.self_flow = self_flow
-        self.web_search_tool = TavilySearchResults(k=3)
+        self.cache = SemanticCache(self_flow.pinecone_handler.embed_query)
+        self.route_prompt = self.generate_route_prompt()
+        self.router_llm = self.llm.with_structured_output(RouteQueryWithConfidence)
+        self.router_chain = self.route_prompt | self.router_llm
+        self.question_rewriter = self.generate_question_rewriter()
+        self.rag_chain = get_hub_prompt("rlm/rag-prompt") | self.llm | StrOutputParser()
+        self.branch_pool = ThreadPoolExecutor(max_workers=4)
         self.graph = self.generate_graph()
 
+    def generate_route_prompt(self):
+        system = """You are an expert at routing a user question to a vectorstore or web search.
+        The vectorstore contains documents related to agents, prompt engineering, and adversarial attacks.
+        Use the vectorstore for questions on these topics. Otherwise, use web-search.
+        Also give the probability that the chosen datasource is the right one."""
+        route_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system),
+                ("human", "{question}"),
+            ]
+        )
+        return route_prompt
+
+    def generate_question_rewriter(self):
+        re_write_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", """You are a question re-writer that converts an input question to a better version that is optimized 
+            for web search. Look at the input and try to reason about the underlying semantic intent / meaning.
+            Formulate an improved question for web search."""),
+                ("human", "Here is the initial question: \n\n {question}"),
+            ]
+        )
+        question_rewriter = re_write_prompt | self.llm | StrOutputParser()
+        return question_rewriter
+
     def generate_graph(self):
         flow = StateGraph(AdaptiveState)
         flow.add_node("call_self_rag", self.call_self_rag)
         flow.add_node("generate_answer", self.generate_answer)
         flow.add_node("web_search", self.search_web)
         flow.add_node("transform_query", self.transform_query)
+        flow.add_node("call_both", self.call_both)
 
         # FIXED: Added proper edge mapping dictionary
         flow.add_conditional_edges(
@@ -38,10 +73,12 @@ class AdaptiveFlow:
             self.route_query,
             {
                 "web_search": "transform_query",
-                "call_self_rag": "call_self_rag"
+                "call_self_rag": "call_self_rag",
+                "call_both": "call_both"
             }
         )
         flow.add_edge("call_self_rag", END)
+        flow.add_edge("call_both", END)
         flow.add_edge("transform_query", "web_search")
         flow.add_edge("web_search", "generate_answer")
         flow.add_edge("generate_answer", END)
@@ -49,118 +86,181 @@ class AdaptiveFlow:
         return flow.compile()
 
     def route_query(self, state: AdaptiveState):
-        structured_llm_router = self.llm.with_structured_output(RouteQuery)
-        # Prompt
-        system = """You are an expert at routing a user question to a vectorstore or web search.
-        The vectorstore contains documents related to agents, prompt engineering, and adversarial attacks.
-        Use the vectorstore for questions on these topics. Otherwise, use web-search.
-        {question}
-        """
-        route_prompt = ChatPromptTemplate.from_template(
-            system
-        )
-        question_router = route_prompt | structured_llm_router
-        next_step = question_router.invoke({"question": state["question"]})
+        next_step = self.router_chain.invoke({"question": state.question})
 
-        # FIXED: Access the datasource attribute properly
-        if next_step.datasource == "web-search":
-            print(f"---ROUTING TO WEB SEARCH---")
+        # An uncertain router runs both branches instead of guessing
+        if next_step.confidence <= 0.6:
+            log.debug("---ROUTING TO SELF RAG AND WEB SEARCH (confidence %s)---", next_step.confidence)
+            return "call_both"
+        if next_step.datasource == "web_search":
+            log.debug("---ROUTING TO WEB SEARCH---")
             return "web_search"
         else:
-            print(f"---ROUTING TO SELF RAG---")
+            log.debug("---ROUTING TO SELF RAG---")
             return "call_self_rag"
 
     def call_self_rag(self, state):
-        print("---CALLING SELF RAG---")
-        question = state["question"]
+        log.debug("---CALLING SELF RAG---")
+        question = state.question
 
         try:
-            self_flow_state = self.self_flow.run(question)
-            return {
-                "generation": self_flow_state["generation"],
-                "question": self_flow_state["question"],
-                "documents": self_flow_state["documents"]
-            }
+            # AdaptiveState covers every SelfState key, so the result is a valid update.
+            # run() already looked the question up in the adaptive cache, so skip the
+            # self RAG cache instead of embedding the question a second time.
+            return self.self_flow.run(question, use_cache=False)
         except Exception as e:
-            print(f"Error in self_flow: {e}")
+            log.warning("Error in self_flow: %s", e)
             # Fallback response
             return {
                 "generation": f"I encountered an issue processing your question about: {question}",
                 "question": question,
-                "documents": []
+                "documents": (),
+                "cacheable": False
             }
 
-    def transform_query(self, state):
-        print("---TRANSFORM QUERY FOR WEB SEARCH---")
-        question = state["question"]
-        documents = state.get("documents", [])
+    def call_both(self, state):
+        log.debug("---CALLING SELF RAG AND WEB SEARCH---")
+        self_rag_future = self.branch_pool.submit(self.call_self_rag, state)
+        web_future = self.branch_pool.submit(self.call_web_search, state)
 
-        # FIXED: Proper string formatting
-        re_write_prompt = ChatPromptTemplate.from_template(
-            """You are a question re-writer that converts an input question to a better version that is optimized 
-            for web search. Look at the input and try to reason about the underlying semantic intent / meaning.
-            Here is the initial question: 
+        # Keep the self RAG answer when it is grounded in documents and addresses the question.
+        # The web branch has already started and runs to completion in the background either way.
+        self_rag_state = self_rag_future.result()
+        try:
+            if self.is_grounded_answer(state.question, self_rag_state):
+                log.debug("---DECISION: USING SELF RAG ANSWER---")
+                return self_rag_state
+        except Exception as e:
+            log.warning("Error grading self RAG answer: %s", e)
+
+        try:
+            web_state = web_future.result()
+            log.debug("---DECISION: USING WEB SEARCH ANSWER---")
+            return web_state
+        except Exception as e:
+            log.warning("Web search branch failed: %s", e)
+            return self_rag_state
 
-            {question} 
+    def is_grounded_answer(self, question, self_rag_state):
+        """
+        Grades a self RAG result with SelfFlow's hallucination and answer
+        graders. Both grades are shared with SelfFlow's grader cache, so an
+        answer SelfFlow already accepted is not graded again.
+        """
+        documents = self_rag_state["documents"]
+        generation = self_rag_state["generation"]
+        if not documents:
+            return False
 
-            Formulate an improved question for web search."""
+        hallucination_future = self.self_flow.grader_pool.submit(
+            self.self_flow.grade,
+            "hallucination",
+            self.self_flow.hallucination_grader,
+            {"documents": documents, "generation": generation}
         )
-        question_rewriter = re_write_prompt | self.llm | StrOutputParser()
+        answer_future = self.self_flow.grader_pool.submit(
+            self.self_flow.grade,
+            "answer",
+            self.self_flow.answer_grader,
+            {"question": question, "generation": generation}
+        )
+        return hallucination_future.result() == "yes" and answer_future.result() == "yes"
+
+    def call_web_search(self, state):
+        state = replace(state, **self.transform_query(state))
+        state = replace(state, **self.search_web(state))
+        return self.generate_answer(state)
+
+    def transform_query(self, state):
+        log.debug("---TRANSFORM QUERY FOR WEB SEARCH---")
+        question = state.question
+        documents = state.documents
 
         # Re-write question
-        better_question = question_rewriter.invoke({"question": question})
-        print(f"Original: {question}")
-        print(f"Transformed: {better_question}")
+        better_question = self.question_rewriter.invoke({"question": question})
+        log.debug("Original: %s", question)
+        log.debug("Transformed: %s", better_question)
 
         return {"documents": documents, "question": better_question}
 
     def search_web(self, state):
-        print("---WEB SEARCH---")
-        question = state["question"]
+        log.debug("---WEB SEARCH---")
+        question = state.question
 
         try:
-            docs = self.web_search_tool.invoke({"query": question})
-            web_results = "\n".join([d["content"] for d in docs])
-            web_results = Document(page_content=web_results)
-            print(f"Found {len(docs)} web results")
-            return {"documents": web_results, "question": question}
+            docs = run_web_search(question, cache_key=state.original_question)
+            log.debug("Found %d web results", len(docs))
+            return {"documents": (docs_to_document(docs),), "question": question}
         except Exception as e:
-            print(f"Web search failed: {e}")
-            # Return empty document if web search fails
-            return {"documents": Document(page_content=""), "question": question}
+            log.warning("Web search failed: %s", e)
+            # Return no documents if web search fails
+            return {"documents": (), "question": question}
 
     def generate_answer(self, state):
-        print("---GENERATE ANSWER FROM WEB RESULTS---")
-        question = state["question"]
-        documents = state["documents"]
+        log.debug("---GENERATE ANSWER FROM WEB RESULTS---")
+        question = state.question
+        documents = state.documents
 
         try:
-            prompt = hub.pull("rlm/rag-prompt")
-            # Chain
-            rag_chain = prompt | self.llm | StrOutputParser()
             # RAG generation
-            generation = rag_chain.invoke({"context": documents, "question": question})
-            return {"documents": documents, "question": question, "generation": generation}
+            generation = self.rag_chain.invoke({"context": documents, "question": question})
+            # Without web results the answer is not grounded in anything worth caching
+            return {"documents": documents, "question": question, "generation": generation, "cacheable": bool(documents)}
         except Exception as e:
-            print(f"Generation failed: {e}")
+            log.warning("Generation failed: %s", e)
             return {
                 "documents": documents,
                 "question": question,
-                "generation": f"I couldn't generate a proper answer for: {question}"
+                "generation": f"I couldn't generate a proper answer for: {question}",
+                "cacheable": False
             }
 
     def run(self, question: str):
+        question = sys.intern(question)
+        # Near-duplicate questions skip the whole graph
         try:
-            return self.graph.invoke({
+            vector = self.cache.embed(question)
+            cached = self.cache.get(vector)
+        except Exception as e:
+            log.warning("Semantic cache unavailable: %s", e)
+            vector, cached = None, None
+        if cached is not None:
+            log.debug("---SEMANTIC CACHE HIT---")
+            return dict(cached)
+
+        try:
+            result = self.graph.invoke({
                 "question": question,
+                "original_question": question,
                 "generation": "",
-                "documents": []
+                "documents": ()
             })
+            if vector is not None and result["cacheable"]:
+                self.cache.put(vector, result)
+            return result
         except Exception as e:
-            print(f"AdaptiveFlow error: {e}")
+            log.warning("AdaptiveFlow error: %s", e)
             # Return fallback response
             return {
                 "question": question,
                 "generation": f"I encountered an error processing your question: {question}",
-                "documents": []
-            }
\ No newline at end of file
+                "documents": (),
+                "cacheable": False
+            }
+
+    def stream(self, question: str):
+        """
+        Yields answer tokens from the web search branch as the LLM produces
+        them. Self RAG answers are yielded whole, since SelfFlow grades a
+        generation before it is accepted and may retry it.
+        """
+        return stream_generation(
+            self.graph,
+            {
+                "question": sys.intern(question),
+                "original_question": question,
+                "generation": "",
+                "documents": ()
+            },
+            token_nodes=("generate_answer",)
+        )
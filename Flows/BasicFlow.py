@@ -1,9 +1,8 @@
 import os
 
-from langchain import hub
 from langchain_core.output_parsers import StrOutputParser
-from langchain_google_genai import ChatGoogleGenerativeAI
 
+from Handlers.LLMHandler import get_hub_prompt, get_llm
 from States.BasicState import BasicState
 
 
@@ -11,15 +10,10 @@ class BasicFlow:
 
     def __init__(self , pinecone_handler):
         self.pinecone_handler = pinecone_handler
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            api_key=os.getenv("GEMINI_API_KEY")
-        )
+        self.llm = get_llm("gemini-2.0-flash", os.getenv("GEMINI_API_KEY"))
+        self.rag_chain = get_hub_prompt("rlm/rag-prompt") | self.llm | StrOutputParser()
 
     def run(self  , question : str) -> BasicState :
         documents = self.pinecone_handler.compare_embeddings(question)
-        prompt = hub.pull("rlm/rag-prompt")
-        # Chain
-        rag_chain = prompt | self.llm | StrOutputParser()
-        generation = rag_chain.invoke({"question" : question , "context" : documents})
+        generation = self.rag_chain.invoke({"question" : question , "context" : documents})
         return {"generation" : generation , "question" : question , "documents" : documents}
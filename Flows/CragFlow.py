@@ -1,28 +1,55 @@
+import logging
 import os
-from langchain import hub
-from langchain_community.tools import TavilySearchResults
+import sys
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.schema import Document
 from langgraph.constants import END, START
 from langgraph.graph import StateGraph
 
 from States.CragState import CragState
-from Models.GradeDocuments import GradeDocuments
+from Models.GradeDocumentsBatch import GradeDocumentsBatch
+from Handlers.LLMHandler import get_hub_prompt, get_llm
 from Handlers.PineConeHandler import PineConeHandler
+from Handlers.StreamHandler import stream_generation
+from Handlers.WebSearchHandler import docs_to_document, run_web_search
 
 
+log = logging.getLogger(__name__)
+
 class CragFlow:
     def __init__(self  , pinecone_handler : PineConeHandler):
         self.pinecone_handler = pinecone_handler
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            api_key=os.getenv("GEMINI_API_KEY")
-        )
-        self.structured_llm_grader = self.llm.with_structured_output(GradeDocuments)
+        self.llm = get_llm("gemini-2.0-flash", os.getenv("GEMINI_API_KEY"))
+        self.structured_llm_grader = self.llm.with_structured_output(GradeDocumentsBatch)
+        self.retrieval_grader = self.generate_retrieval_grader()
+        self.question_rewriter = self.generate_question_rewriter()
+        self.rag_chain = get_hub_prompt("rlm/rag-prompt") | self.llm | StrOutputParser()
         self.graph = self.build_graph()
-        self.web_search_tool = TavilySearchResults(k=3)
+
+    def generate_retrieval_grader(self):
+        prompt = """You are a grader assessing relevance of numbered retrieved documents to a user question. \n 
+            Grade every document on its own. \n
+            If the document contains keyword(s) or semantic meaning related to the question, grade it as relevant. \n
+            For each document give its number and a binary score 'yes' or 'no' to indicate whether it is relevant to the question."""
+        grade_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", prompt),
+                ("human", "Retrieved documents: \n\n {documents} \n\n User question: {question}"),
+            ]
+        )
+        retrieval_grader = grade_prompt | self.structured_llm_grader
+        return retrieval_grader
+
+    def generate_question_rewriter(self):
+        re_write_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", """You a question re-writer that converts an input question to a better version that is optimized \n 
+                         for web search. Look at the input and try to reason about the underlying semantic intent / meaning."""),
+                ("human", "Here is the initial question: \n\n {question} \n Formulate an improved question."),
+            ]
+        )
+        question_rewriter = re_write_prompt | self.llm | StrOutputParser()
+        return question_rewriter
 
     def build_graph(self):
         workflow = StateGraph(CragState)
@@ -52,110 +79,117 @@ class CragFlow:
 
     def retriever(self , state):
 
-        print("---RETRIEVE---")
-        question = state["question"]
+        log.debug("---RETRIEVE---")
+        question = state.question
 
         # Retrieval
-        documents = self.pinecone_handler.compare_embeddings(question)
+        documents = tuple(self.pinecone_handler.compare_embeddings(question))
         return {"documents": documents, "question": question}
 
     def generate(self , state):
 
-        print("---GENERATE---")
-        question = state["question"]
-        documents = state["documents"]
-        prompt = hub.pull("rlm/rag-prompt")
-
-        # Chain
-        rag_chain = prompt | self.llm | StrOutputParser()
-
-        # RAG generation
-        generation = rag_chain.invoke({"context": documents, "question": question})
+        log.debug("---GENERATE---")
+        question = state.question
+        documents = state.documents
+        try:
+            # RAG generation
+            generation = self.rag_chain.invoke({"context": documents, "question": question})
+        except Exception as e:
+            log.warning("Generation error: %s", e)
+            generation = f"I encountered an error while generating a response for: '{question}'"
         return {"documents": documents, "question": question, "generation": generation}
 
     def grade_documents(self ,state):
 
-        print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
-        question = state["question"]
-        documents = state["documents"]
-        prompt = """You are a grader assessing relevance of a retrieved document to a user question. \n 
-            If the document contains keyword(s) or semantic meaning related to the question, grade it as relevant. \n
-            Give a binary score 'yes' or 'no' score to indicate whether the document is relevant to the question.
-            Retrieved document: \n\n {document} \n\n User question: {question}"""
-        grade_prompt = ChatPromptTemplate.from_template(
-          prompt
-        )
-        retrieval_grader = grade_prompt |self.structured_llm_grader
-        # Score each doc
+        log.debug("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
+        question = state.question
+        documents = state.documents
+        # Score all docs in a single call, a doc without a grade is kept
+        verdicts = {}
+        if documents:
+            try:
+                score = self.retrieval_grader.invoke({
+                    "question": question,
+                    "documents": "\n\n".join(f"[{n}] {d.page_content}" for n, d in enumerate(documents, 1))
+                })
+                verdicts = {g.index: g.binary_score for g in score.grades}
+            except Exception as e:
+                log.warning("Error grading documents: %s", e)
         filtered_docs = []
         web_search = "No"
-        for d in documents:
-            score = retrieval_grader.invoke(
-                {"question": question, "document": d.page_content}
-            )
-            grade = score.binary_score
-            print(f"score of answer {grade}")
+        for n, d in enumerate(documents, 1):
+            grade = verdicts.get(n, "yes")
+            log.debug("score of answer %s", grade)
             if grade == "yes":
-                print("---GRADE: DOCUMENT RELEVANT---")
+                log.debug("---GRADE: DOCUMENT RELEVANT---")
                 filtered_docs.append(d)
             else:
-                print("---GRADE: DOCUMENT NOT RELEVANT---")
+                log.debug("---GRADE: DOCUMENT NOT RELEVANT---")
                 web_search = "Yes"
                 continue
-        return {"documents": filtered_docs, "question": question, "web_search": web_search}
+        return {"documents": tuple(filtered_docs), "question": question, "web_search": web_search}
 
     def transform_query(self , state):
 
-        print("---TRANSFORM QUERY---")
-        question = state["question"]
-        documents = state["documents"]
-        re_write_prompt = ChatPromptTemplate.from_template(
-            """You a question re-writer that converts an input question to a better version that is optimized \n 
-                         for web search. Look at the input and try to reason about the underlying semantic intent / meaning."""
-                    "Here is the initial question: \n\n {question} \n Formulate an improved question.",
-
-        )
-        question_rewriter = re_write_prompt | self.llm | StrOutputParser()
+        log.debug("---TRANSFORM QUERY---")
+        question = state.question
+        documents = state.documents
         # Re-write question
-        better_question = question_rewriter.invoke({"question": question})
+        better_question = self.question_rewriter.invoke({"question": question})
         return {"documents": documents, "question": better_question}
 
     def web_search(self , state):
 
-        print("---WEB SEARCH---")
-        question = state["question"]
-        documents = state["documents"]
+        log.debug("---WEB SEARCH---")
+        question = state.question
+        documents = state.documents
 
-        # Web search
-        docs = self.web_search_tool.invoke({"query": question})
-        web_results = "\n".join([d.page_content for d in docs])
-        web_results = Document(page_content=web_results)
-        documents.append(web_results)
+        # Web search, an unavailable search keeps the graded documents only
+        try:
+            docs = run_web_search(question, cache_key=state.original_question)
+            documents = documents + (docs_to_document(docs),)
+        except Exception as e:
+            log.warning("Web search failed: %s", e)
 
         return {"documents": documents, "question": question}
 
     ### Edges
 
     def decide_to_generate(self , state):
-        print("---ASSESS GRADED DOCUMENTS---")
-        web_search = state["web_search"]
+        log.debug("---ASSESS GRADED DOCUMENTS---")
+        web_search = state.web_search
         if web_search == "Yes":
-            print(
+            log.debug(
                 "---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---"
             )
             return "transform_query"
         else:
-            print("---DECISION: GENERATE---")
+            log.debug("---DECISION: GENERATE---")
             return "generate"
 
     def run(self , question : str):
         return self.graph.invoke(
             {
-                "question" : question,
+                "question" : sys.intern(question),
+                "original_question" : question,
                 "generation": "" ,
                 "web_search": "" ,
-                "documents": []
+                "documents": ()
             }
         )
 
-
+    def stream(self , question : str):
+        """
+        Yields answer tokens from the generate node as the LLM produces them,
+        or the whole fallback answer when generation fails.
+        """
+        return stream_generation(
+            self.graph,
+            {
+                "question" : sys.intern(question),
+                "original_question" : question,
+                "generation": "" ,
+                "web_search": "" ,
+                "documents": ()
+            }
+        )
@@ -1,58 +1,73 @@
+import logging
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from langchain import hub
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.constants import END, START
 from langgraph.graph import StateGraph
 
+from Handlers.LLMHandler import get_hub_prompt, get_llm
 from Models.GradeAnswer import GradeAnswer
-from Models.GradeDocuments import GradeDocuments
+from Models.GradeDocumentsBatch import GradeDocumentsBatch
 from Models.GradeHallucinations import GradeHallucinations
+from Handlers.GraderCache import GraderCache
 from Handlers.PineConeHandler import PineConeHandler
+from Handlers.SemanticCache import SemanticCache
+from Handlers.StreamHandler import stream_generation
 from States.SelfState import SelfState
 
 
+log = logging.getLogger(__name__)
+
 class SelfFlow:
     def __init__(self, pinecone_handler: PineConeHandler):
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            api_key=os.getenv('GEMINI_API_KEY')
-        )
+        self.llm = get_llm("gemini-2.0-flash", os.getenv("GEMINI_API_KEY"))
         self.pinecone_handler = pinecone_handler
+        self.cache = SemanticCache(pinecone_handler.embed_query)
         self.graph = self.generate_graph()
         self.answer_grader = self.generate_answer_grader()
         self.retrieval_grader = self.generate_retrieval_grader()
         self.hallucination_grader = self.generate_hallucinations_grader()
+        self.grader_cache = GraderCache()
+        self.grader_pool = ThreadPoolExecutor(max_workers=8)
+        self.rewriter_chain_v1 = self.generate_question_rewriter(broaden=False)
+        self.rewriter_chain_v2 = self.generate_question_rewriter(broaden=True)
+        self.rag_chain = get_hub_prompt("rlm/rag-prompt") | self.llm | StrOutputParser()
 
     def generate_hallucinations_grader(self):
         structured_llm_grader = self.llm.with_structured_output(GradeHallucinations)
 
         # Prompt
         system = """You are a grader assessing whether an LLM generation is grounded in / supported by a set of retrieved facts. \n 
-             Give a binary score 'yes' or 'no'. 'Yes' means that the answer is grounded in / supported by the set of facts.
-             "Set of facts: \n\n {documents} \n\n LLM generation: {generation}"""
-        hallucination_prompt = ChatPromptTemplate.from_template(
-            system
+             Give a binary score 'yes' or 'no'. 'Yes' means that the answer is grounded in / supported by the set of facts."""
+        hallucination_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system),
+                ("human", "Set of facts: \n\n {documents} \n\n LLM generation: {generation}"),
+            ]
         )
         hallucination_grader = hallucination_prompt | structured_llm_grader
         return hallucination_grader
 
     def generate_retrieval_grader(self):
-        structured_llm_grader = self.llm.with_structured_output(GradeDocuments)
+        structured_llm_grader = self.llm.with_structured_output(GradeDocumentsBatch)
 
         # MADE MORE LENIENT - relaxed criteria for relevance
-        system = """You are a grader assessing relevance of a retrieved document to a user question. \n 
+        system = """You are a grader assessing relevance of numbered retrieved documents to a user question. \n 
+            Grade every document on its own. \n
             Be LENIENT and GENEROUS in your assessment. The goal is to keep potentially useful documents. \n
             If the document contains ANY keywords, concepts, or semantic meaning that could be REMOTELY related to the user question, grade it as relevant. \n
             Even if the connection is indirect or tangential, still mark it as relevant. \n
             Only reject documents that are completely unrelated or contain no useful information at all. \n
             When in doubt, choose 'yes'. \n
-            Give a binary score 'yes' or 'no' score to indicate whether the document is relevant to the question.
-            Retrieved document: \n\n {document} \n\n User question: {question}"""
-        grade_prompt = ChatPromptTemplate.from_template(
-            system
+            For each document give its number and a binary score 'yes' or 'no' to indicate whether it is relevant to the question."""
+        grade_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system),
+                ("human", "Retrieved documents: \n\n {documents} \n\n User question: {question}"),
+            ]
         )
         retrieval_grader = grade_prompt | structured_llm_grader
         return retrieval_grader
@@ -62,14 +77,45 @@ class SelfFlow:
 
         # Prompt
         system = """You are a grader assessing whether an answer addresses / resolves a question \n 
-             Give a binary score 'yes' or 'no'. Yes' means that the answer resolves the question.
-             User question: \n\n {question} \n\n LLM generation: {generation}"""
-        answer_prompt = ChatPromptTemplate.from_template(
-            system
+             Give a binary score 'yes' or 'no'. Yes' means that the answer resolves the question."""
+        answer_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system),
+                ("human", "User question: \n\n {question} \n\n LLM generation: {generation}"),
+            ]
         )
         answer_grader = answer_prompt | structured_llm_grader
         return answer_grader
 
+    def grade(self, grader_name, grader, inputs):
+        key = self.grader_cache.cache_key(grader_name, inputs)
+        grade = self.grader_cache.get(key)
+        if grade is None:
+            grade = grader.invoke(inputs).binary_score
+            self.grader_cache.put(key, grade)
+        return grade
+
+    def generate_question_rewriter(self, broaden: bool):
+        if broaden:
+            system = """You are a question re-writer that converts an input question to a much simpler and broader version 
+                 for vectorstore retrieval. Make the question more general and use common keywords that are likely to match documents.
+                 Remove specific details and focus on the core concepts.
+                 Formulate a much simpler, broader question using basic keywords."""
+        else:
+            system = """You are a question re-writer that converts an input question to a better version that is optimized \n 
+                 for vectorstore retrieval. Look at the input and try to reason about the underlying semantic intent / meaning.
+                 Use different keywords and rephrase to improve matching with stored documents.
+                 Formulate an improved question."""
+
+        re_write_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system),
+                ("human", "Here is the initial question: \n\n {question}"),
+            ]
+        )
+        question_rewriter = re_write_prompt | self.llm | StrOutputParser()
+        return question_rewriter
+
     def generate_graph(self):
         workflow = StateGraph(SelfState)
 
@@ -78,10 +124,19 @@ class SelfFlow:
         workflow.add_node("grade_documents", self.grade_documents)  # grade documents
         workflow.add_node("generate", self.generate)  # generate
         workflow.add_node("transform_query", self.transform_query)  # transform_query
+        workflow.add_node("skip_cache", self.skip_cache)  # ungraded generation
 
         # Build graph
         workflow.add_edge(START, "retrieve")
-        workflow.add_edge("retrieve", "grade_documents")
+        workflow.add_conditional_edges(
+            "retrieve",
+            self.should_grade,
+            {
+                "grade_documents": "grade_documents",
+                "transform_query": "transform_query",
+                "generate": "generate",
+            },
+        )
         workflow.add_conditional_edges(
             "grade_documents",
             self.decide_to_generate,
@@ -98,22 +153,24 @@ class SelfFlow:
                 "not supported": "generate",
                 "useful": END,
                 "not useful": "transform_query",
+                "ungraded": "skip_cache",
             },
         )
+        workflow.add_edge("skip_cache", END)
         return workflow.compile()
 
     def retrieve(self, state):
-        print("---RETRIEVE---")
-        question = state["question"]
-        retry_count = state.get("retry_count", 0)
+        log.debug("---RETRIEVE---")
+        question = state.question
+        retry_count = state.retry_count
 
         # Retrieval
-        documents = self.pinecone_handler.compare_embeddings(question)
+        documents = tuple(self.pinecone_handler.compare_embeddings(question))
 
         # Debug info
-        print(f"Retrieved {len(documents)} documents for attempt #{retry_count + 1}")
-        if documents:
-            print(f"First document preview: {documents[0].page_content[:150]}...")
+        log.debug("Retrieved %d documents for attempt #%d", len(documents), retry_count + 1)
+        if documents and log.isEnabledFor(logging.DEBUG):
+            log.debug("First document preview: %s...", documents[0].page_content[:150])
 
         return {
             "documents": documents,
@@ -122,108 +179,110 @@ class SelfFlow:
         }
 
     def generate(self, state):
-        print("---GENERATE---")
-        question = state["question"]
-        documents = state["documents"]
-        retry_count = state.get("retry_count", 0)
+        log.debug("---GENERATE---")
+        question = state.question
+        documents = state.documents
+        retry_count = state.retry_count
 
         # If no documents available, provide fallback response
+        cacheable = False
         if not documents:
-            print("---NO DOCUMENTS AVAILABLE, GENERATING FALLBACK RESPONSE---")
+            log.debug("---NO DOCUMENTS AVAILABLE, GENERATING FALLBACK RESPONSE---")
             generation = f"I don't have specific information in my knowledge base about: '{question}'. This question may require information that's not available in my current documents."
         else:
             try:
-                prompt = hub.pull("rlm/rag-prompt")
-                # Chain
-                rag_chain = prompt | self.llm | StrOutputParser()
                 # RAG generation
-                generation = rag_chain.invoke({"context": documents, "question": question})
+                generation = self.rag_chain.invoke({"context": documents, "question": question})
+                cacheable = True
             except Exception as e:
-                print(f"Generation error: {e}")
+                log.warning("Generation error: %s", e)
                 generation = f"I encountered an error while generating a response for: '{question}'"
 
         return {
             "documents": documents,
             "question": question,
             "generation": generation,
-            "retry_count": retry_count
+            "retry_count": retry_count,
+            "cacheable": cacheable
         }
 
     def grade_documents(self, state):
-        print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
-        question = state["question"]
-        documents = state["documents"]
-        retry_count = state.get("retry_count", 0)
-
-        print(f"Grading {len(documents)} documents (attempt #{retry_count + 1})")
-
-        # If we've retried multiple times, be even more lenient
-        if retry_count >= 2:
-            print("---MAX RETRIES REACHED, ACCEPTING ALL DOCUMENTS---")
-            return {
-                "documents": documents,
-                "question": question,
-                "retry_count": retry_count
-            }
-
-        # Score each doc
-        filtered_docs = []
-        for i, d in enumerate(documents):
+        log.debug("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
+        question = state.question
+        documents = state.documents
+        retry_count = state.retry_count
+
+        log.debug("Grading %d documents (attempt #%d)", len(documents), retry_count + 1)
+
+        # Reuse cached grades, then score the remaining docs in a single call
+        keys = [
+            self.grader_cache.cache_key("retrieval", {"question": question, "document": d.page_content})
+            for d in documents
+        ]
+        grades = [self.grader_cache.get(key) for key in keys]
+        misses = [i for i, grade in enumerate(grades) if grade is None]
+        if misses:
             try:
-                score = self.retrieval_grader.invoke(
-                    {"question": question, "document": d.page_content}
-                )
-                grade = score.binary_score
-                print(f"Document {i + 1} score: {grade}")
-
-                if grade == "yes":
-                    print("---GRADE: DOCUMENT RELEVANT---")
-                    filtered_docs.append(d)
-                else:
-                    print("---GRADE: DOCUMENT NOT RELEVANT---")
-                    print(f"Rejected doc preview: {d.page_content[:100]}...")
+                score = self.retrieval_grader.invoke({
+                    "question": question,
+                    "documents": "\n\n".join(
+                        f"[{n}] {documents[i].page_content}" for n, i in enumerate(misses, 1)
+                    )
+                })
+                verdicts = {g.index: g.binary_score for g in score.grades}
             except Exception as e:
-                print(f"Error grading document {i + 1}: {e}")
+                log.warning("Error grading documents: %s", e)
+                verdicts = {}
+            for n, i in enumerate(misses, 1):
+                if n in verdicts:
+                    grades[i] = verdicts[n]
+                    self.grader_cache.put(keys[i], grades[i])
+
+        filtered_docs = []
+        for i, (d, grade) in enumerate(zip(documents, grades)):
+            if grade is None:
+                log.debug("No grade for document %d", i + 1)
                 # If grading fails, keep the document to be safe
                 filtered_docs.append(d)
+                continue
 
-        print(f"Filtered to {len(filtered_docs)} relevant documents")
+            log.debug("Document %d score: %s", i + 1, grade)
+
+            if grade == "yes":
+                log.debug("---GRADE: DOCUMENT RELEVANT---")
+                filtered_docs.append(d)
+            else:
+                log.debug("---GRADE: DOCUMENT NOT RELEVANT---")
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Rejected doc preview: %s...", d.page_content[:100])
+
+        log.debug("Filtered to %d relevant documents", len(filtered_docs))
         return {
-            "documents": filtered_docs,
+            "documents": tuple(filtered_docs),
             "question": question,
             "retry_count": retry_count
         }
 
     def transform_query(self, state):
-        print("---TRANSFORM QUERY---")
-        question = state["question"]
-        documents = state["documents"]
-        retry_count = state.get("retry_count", 0) + 1
+        log.debug("---TRANSFORM QUERY---")
+        question = state.question
+        documents = state.documents
+        retry_count = state.retry_count + 1
 
-        print(f"Query transformation attempt #{retry_count}")
-        print(f"Original question: {question}")
+        log.debug("Query transformation attempt #%d", retry_count)
+        log.debug("Original question: %s", question)
 
         # Make transformation more aggressive after multiple attempts
         if retry_count >= 2:
-            system = """You are a question re-writer that converts an input question to a much simpler and broader version 
-                 for vectorstore retrieval. Make the question more general and use common keywords that are likely to match documents.
-                 Remove specific details and focus on the core concepts.
-                 Here is the initial question: \n\n {question} \n 
-                 Formulate a much simpler, broader question using basic keywords."""
+            question_rewriter = self.rewriter_chain_v2
         else:
-            system = """You are a question re-writer that converts an input question to a better version that is optimized \n 
-                 for vectorstore retrieval. Look at the input and try to reason about the underlying semantic intent / meaning.
-                 Use different keywords and rephrase to improve matching with stored documents.
-                 Here is the initial question: \n\n {question} \n Formulate an improved question."""
-
-        re_write_prompt = ChatPromptTemplate.from_template(system)
-        question_rewriter = re_write_prompt | self.llm | StrOutputParser()
+            question_rewriter = self.rewriter_chain_v1
 
         try:
             better_question = question_rewriter.invoke({"question": question})
-            print(f"Transformed question: {better_question}")
+            log.debug("Transformed question: %s", better_question)
         except Exception as e:
-            print(f"Query transformation failed: {e}")
+            log.warning("Query transformation failed: %s", e)
             better_question = question  # Keep original if transformation fails
 
         return {
@@ -232,88 +291,153 @@ class SelfFlow:
             "retry_count": retry_count
         }
 
+    def skip_cache(self, state):
+        log.debug("---GENERATION NOT GRADED, SKIPPING CACHE---")
+        return {"cacheable": False}
+
     ### Edges
 
+    def should_grade(self, state):
+        documents = state.documents
+        retry_count = state.retry_count
+
+        # Nothing to grade, so route as if grading rejected everything
+        if not documents:
+            return self.decide_to_generate(state)
+        # If we've retried multiple times, be even more lenient
+        if retry_count >= 2:
+            log.debug("---MAX RETRIES REACHED, ACCEPTING ALL DOCUMENTS---")
+            return "generate"
+        return "grade_documents"
+
     def decide_to_generate(self, state):
-        print("---ASSESS GRADED DOCUMENTS---")
-        filtered_documents = state["documents"]
-        retry_count = state.get("retry_count", 0)
+        log.debug("---ASSESS GRADED DOCUMENTS---")
+        filtered_documents = state.documents
+        retry_count = state.retry_count
 
         if not filtered_documents:
             if retry_count >= 3:
                 # After 3 attempts, force generation even without documents
-                print("---MAX RETRIES EXCEEDED, FORCING GENERATION WITH NO DOCUMENTS---")
+                log.debug("---MAX RETRIES EXCEEDED, FORCING GENERATION WITH NO DOCUMENTS---")
                 return "generate"
             else:
-                print("---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---")
+                log.debug("---DECISION: ALL DOCUMENTS ARE NOT RELEVANT TO QUESTION, TRANSFORM QUERY---")
                 return "transform_query"
         else:
             # We have relevant documents, so generate answer
-            print("---DECISION: GENERATE---")
+            log.debug("---DECISION: GENERATE---")
             return "generate"
 
     def grade_generation_v_documents_and_question(self, state):
-        print("---CHECK HALLUCINATIONS---")
-        question = state["question"]
-        documents = state["documents"]
-        generation = state["generation"]
-        retry_count = state.get("retry_count", 0)
+        log.debug("---CHECK HALLUCINATIONS---")
+        question = state.question
+        documents = state.documents
+        generation = state.generation
+        retry_count = state.retry_count
 
         # If we've retried too many times or have no documents, skip strict checking
         if retry_count >= 2 or not documents:
-            print("---ACCEPTING GENERATION DUE TO RETRY LIMIT OR NO DOCUMENTS---")
-            return "useful"
+            log.debug("---ACCEPTING GENERATION DUE TO RETRY LIMIT OR NO DOCUMENTS---")
+            return "ungraded"
 
         try:
-            score = self.hallucination_grader.invoke(
+            # Grade the answer speculatively while the hallucination check runs
+            hallucination_future = self.grader_pool.submit(
+                self.grade,
+                "hallucination",
+                self.hallucination_grader,
                 {"documents": documents, "generation": generation}
             )
-            grade = score.binary_score
-            print(f"Hallucination check grade: {grade}")
+            answer_future = self.grader_pool.submit(
+                self.grade,
+                "answer",
+                self.answer_grader,
+                {"question": question, "generation": generation}
+            )
+            grade = hallucination_future.result()
+            log.debug("Hallucination check grade: %s", grade)
 
             # Check hallucination
             if grade == "yes":
-                print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
+                log.debug("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
                 # Check question-answering
-                print("---GRADE GENERATION vs QUESTION---")
-                score = self.answer_grader.invoke({"question": question, "generation": generation})
-                grade = score.binary_score
-                print(f"Answer relevance grade: {grade}")
+                log.debug("---GRADE GENERATION vs QUESTION---")
+                grade = answer_future.result()
+                log.debug("Answer relevance grade: %s", grade)
                 if grade == "yes":
-                    print("---DECISION: GENERATION ADDRESSES QUESTION---")
+                    log.debug("---DECISION: GENERATION ADDRESSES QUESTION---")
                     return "useful"
                 else:
-                    print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
+                    log.debug("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
                     return "not useful"
             else:
-                print("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
+                # The answer grade is not needed, it still completes in the background and lands in GraderCache
+                log.debug("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
                 return "not supported"
         except Exception as e:
-            print(f"Error in grading generation: {e}")
-            # If grading fails, accept the generation
-            return "useful"
-
-    def run(self, question: str):
+            log.warning("Error in grading generation: %s", e)
+            # If grading fails, accept the generation but keep it out of the cache
+            return "ungraded"
+
+    def run(self, question: str, use_cache: bool = True):
+        """
+        Runs the graph for a question. use_cache=False skips the semantic cache,
+        for callers such as AdaptiveFlow that already checked their own.
+        """
+        question = sys.intern(question)
         # Set recursion limit to prevent infinite loops
         config = {"recursion_limit": 15}  # Slightly higher limit to allow for retries
 
+        # Near-duplicate questions skip the whole graph
+        vector, cached = None, None
+        if use_cache:
+            try:
+                vector = self.cache.embed(question)
+                cached = self.cache.get(vector)
+            except Exception as e:
+                log.warning("Semantic cache unavailable: %s", e)
+        if cached is not None:
+            log.debug("---SEMANTIC CACHE HIT---")
+            return dict(cached)
+
         try:
             result = self.graph.invoke(
                 {
                     "question": question,
-                    "documents": [],
+                    "documents": (),
                     "generation": "",
                     "retry_count": 0
                 },
                 config
             )
+            if vector is not None and result["cacheable"]:
+                self.cache.put(vector, result)
             return result
         except Exception as e:
-            print(f"Error in SelfFlow.run(): {e}")
+            log.warning("Error in SelfFlow.run(): %s", e)
             # Return a fallback response
             return {
                 "question": question,
-                "documents": [],
+                "documents": (),
                 "generation": f"I apologize, but I encountered a technical issue while processing your question: '{question}'. This may be due to the question being outside my knowledge base or a system limitation.",
+                "retry_count": 0,
+                "cacheable": False
+            }
+
+    def stream(self, question: str):
+        """
+        Yields answer tokens from the generate node as the LLM produces them.
+        Fallback answers are yielded whole. If the graders reject a generation,
+        STREAM_RESET is yielded before the retried generation.
+        """
+        config = {"recursion_limit": 15}
+        return stream_generation(
+            self.graph,
+            {
+                "question": sys.intern(question),
+                "documents": (),
+                "generation": "",
                 "retry_count": 0
-            }
\ No newline at end of file
+            },
+            config
+        )
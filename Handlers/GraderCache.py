@@ -0,0 +1,36 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+class GraderCache:
+    """
+    Exact-match cache of grader binary scores. Keys are a SHA256 of the grader
+    name and its inputs, so the same (question, document) pair is only sent to
+    the LLM once. The least recently used score is evicted past maxsize.
+    """
+
+    def __init__(self , maxsize : int = 4096):
+        self.maxsize = maxsize
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(grader_name : str , inputs : dict) -> str:
+        payload = json.dumps({"grader": grader_name, "inputs": inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self , key : str):
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+            return score
+
+    def put(self , key : str , score : str):
+        with self._lock:
+            self._scores[key] = score
+            self._scores.move_to_end(key)
+            while len(self._scores) > self.maxsize:
+                self._scores.popitem(last=False)
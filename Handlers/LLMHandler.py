@@ -0,0 +1,30 @@
+import threading
+import time
+from functools import lru_cache
+
+from langchain import hub
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+_HUB_PROMPT_TTL = 3600
+_hub_prompts = {}
+_hub_lock = threading.Lock()
+
+
+def get_hub_prompt(name : str):
+    """Returns a LangChain Hub prompt, pulled at most once per hour per process."""
+    with _hub_lock:
+        cached = _hub_prompts.get(name)
+        if cached is not None and time.monotonic() - cached[1] < _HUB_PROMPT_TTL:
+            return cached[0]
+        prompt = hub.pull(name)
+        _hub_prompts[name] = (prompt, time.monotonic())
+        return prompt
+
+
+@lru_cache(maxsize=None)
+def get_llm(model : str , api_key : str) -> ChatGoogleGenerativeAI:
+    """Returns one chat model client per (model, api_key), shared by every flow."""
+    return ChatGoogleGenerativeAI(
+        model=model,
+        api_key=api_key
+    )
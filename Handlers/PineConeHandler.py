@@ -1,111 +1,475 @@
+import multiprocessing
 import os
+import queue
+import ssl
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterator
 
-import pandas as pd
 from datasets import load_dataset
 from dotenv import load_dotenv
+import httpx
+import orjson
 from langchain_core.documents import Document
+from pinecone.exceptions import PineconeApiException, PineconeProtocolError
 from pinecone.pinecone import Pinecone
-from langchain_community.document_loaders import PyPDFLoader
+from pypdf import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from semantic_text_splitter import TextSplitter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from tqdm import tqdm
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 
 load_dotenv()
 
+# Pinecone rejects upsert requests larger than 2 MB
+MAX_UPSERT_BYTES = 2 * 1024 * 1024
+# Below this many pages, spawning worker processes costs more than it saves.
+# Workers are spawned rather than forked, so each one re-imports this module (about a second)
+SEQUENTIAL_PDF_PAGES = 16
+# Upsert batches buffered between the record producer and the upload threads
+UPSERT_QUEUE_SIZE = 32
+# Embedding model of the index, also used to embed bulk uploads client side
+EMBED_MODEL = "llama-text-embed-v2"
+EMBED_DEFAULT_DIMENSION = 1024
+# Upper bound on the JSON size of one float in an upsert payload, sign and separator included
+VECTOR_VALUE_BYTES = 24
+# Maximum characters per Q&A chunk
+QA_CHUNK_CAPACITY = 500
+# Data plane API version sent on direct record upserts, the one the pinned pinecone SDK uses
+PINECONE_API_VERSION = "2025-04"
+
+# Shared by every handler in the process so the connection pool and index lookups are reused.
+# Clients are keyed by (proxy_url, ssl_ca_certs), so handlers only share connections configured
+# the same way. pool_threads is fixed by the first handler to create a client for those settings.
+_PC_CLIENTS = {}
+_INDEX_CACHE = {}
+_HTTP_CLIENTS = {}
+_PC_LOCK = threading.Lock()
+
+
+def _extract_pages(file_path : str , start : int , stop : int):
+    reader = PdfReader(file_path)
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+def _get_index(index_name : str , index_host : str , pool_threads : int , embed_dimension : int , proxy_url : str = None , ssl_ca_certs : str = None):
+    """
+    Returns the shared Pinecone client, the Index for index_name and its host
+    URL, creating them on first use. A known host skips the has_index /
+    describe_index control plane calls. Raises ValueError when embed_dimension
+    is set and the index has a different dimension, since embed_dimension only
+    applies when the index is created here.
+    """
+    settings = (proxy_url, ssl_ca_certs)
+    with _PC_LOCK:
+        pc = _PC_CLIENTS.get(settings)
+        if pc is None:
+            pc = _PC_CLIENTS[settings] = Pinecone(
+                api_key= os.getenv('PINECONE_API_KEY'),
+                proxy_url=proxy_url,
+                ssl_ca_certs=ssl_ca_certs,
+                pool_threads=pool_threads
+            )
+
+        # Index objects carry their client's connection settings, so they are cached per settings too
+        key = (settings, index_host or index_name)
+        cached = _INDEX_CACHE.get(key)
+        if cached is not None:
+            index, index_host, dimension = cached
+            if embed_dimension and dimension is None:
+                dimension = index.describe_index_stats().dimension
+                _INDEX_CACHE[key] = (index, index_host, dimension)
+            _check_dimension(index_host, dimension, embed_dimension)
+            return pc, index, index_host
+
+        dimension = None
+        if not index_host:
+            if not pc.has_index(index_name):
+                pc.create_index_for_model(
+                    name=index_name,
+                    cloud="aws",
+                    region="us-east-1",
+                    embed={
+                    "model": EMBED_MODEL,
+                    "field_map": {"text": "chunk_text"},
+                    **({"dimension": embed_dimension} if embed_dimension else {})
+                    }
+                )
+            description = pc.describe_index(index_name)
+            index_host, dimension = description.host, description.dimension
+        if not index_host.startswith(("https://", "http://")):
+            index_host = f"https://{index_host}"
+        index = pc.Index(host=index_host, pool_threads=pool_threads)
+        if embed_dimension and dimension is None:
+            dimension = index.describe_index_stats().dimension
+        _check_dimension(index_host, dimension, embed_dimension)
+        _INDEX_CACHE[key] = (index, index_host, dimension)
+        return pc, index, index_host
+
+
+def _check_dimension(index_key : str , dimension : int , embed_dimension : int):
+    if embed_dimension and dimension != embed_dimension:
+        raise ValueError(
+            f"Index {index_key} has dimension {dimension}, but embed_dimension={embed_dimension} was requested. "
+            f"embed_dimension only applies when the index is created."
+        )
+
+
+# Keyed by the shared Index object, so every handler on an index sees the same results
+# and clear_search_cache() after an upload invalidates them for all of them
+@lru_cache(maxsize=1024)
+def _search_index(index , user_prompt : str):
+    namespace = "rag-space"
+    filtered_results = index.search(
+        namespace= namespace,
+        query= {
+            "top_k" : 3 ,
+            "inputs": {"text": user_prompt}
+        }
+    )
+    results_list = filtered_results['result']['hits']
+    return tuple(results['fields']['text'] for results in results_list)
+
+
+def _get_http_client(proxy_url : str = None , ssl_ca_certs : str = None):
+    """
+    Returns the shared HTTP/2 client used for bulk record upserts with this
+    proxy and CA bundle, the same settings as the handler's Pinecone client.
+    """
+    settings = (proxy_url, ssl_ca_certs)
+    with _PC_LOCK:
+        client = _HTTP_CLIENTS.get(settings)
+        if client is None:
+            client = _HTTP_CLIENTS[settings] = httpx.Client(
+                http2=True,
+                timeout=30,
+                limits=httpx.Limits(max_connections=32),
+                proxy=proxy_url,
+                verify=ssl.create_default_context(cafile=ssl_ca_certs) if ssl_ca_certs else True
+            )
+        return client
+
+
+def _is_retryable(error : BaseException) -> bool:
+    """
+    Network failures, rate limits and server errors are worth retrying, other
+    HTTP errors are not. Covers both the direct httpx upserts and the Pinecone
+    SDK calls, which raise PineconeApiException or urllib3 errors.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    if isinstance(error, PineconeApiException):
+        return error.status is not None and (error.status == 429 or error.status >= 500)
+    return isinstance(error, (httpx.TransportError, PineconeProtocolError, Urllib3HTTPError, ConnectionError))
+
+
 class PineConeHandler:
-    def __init__(self , index_name : str):
-        pc = Pinecone(api_key= os.getenv('PINECONE_API_KEY'))
-        if not pc.has_index(index_name):
-            pc.create_index_for_model(
-                name=index_name,
-                cloud="aws",
-                region="us-east-1",
-                embed={
-                "model": "llama-text-embed-v2",
-                "field_map": {"text": "chunk_text"}
+    def __init__(self , index_name : str , index_host : str = None , pool_threads : int = 30 , batch_size : int = 96 , embed_dimension : int = None , proxy_url : str = None , ssl_ca_certs : str = None):
+        self.batch_size = batch_size
+        # llama-text-embed-v2 can output 384, 512, 768, 1024 or 2048 dimensions, None keeps the 1024 default.
+        # It must match an existing index, a mismatch raises ValueError
+        self.embed_dimension = embed_dimension
+        self.api_key = os.getenv('PINECONE_API_KEY')
+        self.proxy_url = proxy_url
+        self.ssl_ca_certs = ssl_ca_certs
+        # Clients are shared per (proxy_url, ssl_ca_certs), pool_threads only applies to the first handler with those settings
+        self.pc, self.index, self.index_host = _get_index(
+            index_name,
+            index_host or os.getenv('PINECONE_INDEX_HOST'),
+            pool_threads,
+            embed_dimension,
+            proxy_url,
+            ssl_ca_certs
+        )
+        self.splitter = TextSplitter(capacity=QA_CHUNK_CAPACITY, overlap=100)
+        self._page_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+
+    def iter_batches(self , records : list , record_overhead : int = 0):
+        """
+        Yields batches of up to self.batch_size records, starting a new batch
+        early when the serialized payload would go over MAX_UPSERT_BYTES.
+        record_overhead is added to each record's size for bytes the upsert
+        adds to the record, such as its vector values.
+        """
+        batch, batch_bytes = [], 0
+        for record in records:
+            record_bytes = len(orjson.dumps(record)) + record_overhead
+            if batch and (len(batch) == self.batch_size or batch_bytes + record_bytes > MAX_UPSERT_BYTES):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(record)
+            batch_bytes += record_bytes
+        if batch:
+            yield batch
+
+    def split_qa_texts(self , texts : list):
+        """
+        Splits Q&A texts into one chunk list per text. Texts that already fit in
+        a chunk skip the splitter, the rest are split together in one call.
+        """
+        # Most rows are shorter than a chunk, so avoid the splitter call entirely
+        chunks = [[text.strip()] if len(text) <= QA_CHUNK_CAPACITY else None for text in texts]
+        long_rows = [i for i, row_chunks in enumerate(chunks) if row_chunks is None]
+        if long_rows:
+            split = self.splitter.chunk_all([texts[i] for i in long_rows])
+            for i, row_chunks in zip(long_rows, split):
+                chunks[i] = row_chunks
+        return [[chunk for chunk in row_chunks if chunk] for row_chunks in chunks]
+
+    @retry(
+        retry=retry_if_exception(_is_retryable),
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=1, max=30),
+        reraise=True
+    )
+    def upsert_batch(self , namespace : str , batch : list):
+        """
+        Upserts records with one NDJSON request to the index's records endpoint.
+        The body is serialized with orjson and sent over a shared HTTP/2 client,
+        so concurrent batches reuse the same connections.
+        """
+        response = _get_http_client(self.proxy_url, self.ssl_ca_certs).post(
+            f"{self.index_host}/records/namespaces/{namespace}/upsert",
+            content=b"\n".join(orjson.dumps(record) for record in batch),
+            headers={
+                "Api-Key": self.api_key,
+                "Content-Type": "application/x-ndjson",
+                "X-Pinecone-API-Version": PINECONE_API_VERSION
+            }
+        )
+        response.raise_for_status()
+        return len(batch)
+
+    @retry(
+        retry=retry_if_exception(_is_retryable),
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=1, max=30),
+        reraise=True
+    )
+    def embed_passages(self , texts : list):
+        """Embeds a batch of passages with the index's model in one inference call."""
+        parameters = {"input_type": "passage", "truncate": "END"}
+        if self.embed_dimension:
+            parameters["dimension"] = self.embed_dimension
+        embeddings = self.pc.inference.embed(
+            model=EMBED_MODEL,
+            inputs=texts,
+            parameters=parameters
+        )
+        return [embedding["values"] for embedding in embeddings]
+
+    def vector_overhead(self):
+        """Bytes the vector values add to each record in an upsert payload."""
+        return (self.embed_dimension or EMBED_DEFAULT_DIMENSION) * VECTOR_VALUE_BYTES
+
+    @retry(
+        retry=retry_if_exception(_is_retryable),
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=1, max=30),
+        reraise=True
+    )
+    def upsert_vectors(self , namespace : str , vectors : list):
+        self.index.upsert(vectors=vectors, namespace=namespace)
+        return len(vectors)
+
+    def upsert_vector_batch(self , namespace : str , batch : list):
+        """
+        Embeds a batch of records client side and upserts the dense vectors,
+        keeping every other record field as metadata. The embedding is done
+        once, only the upsert is retried.
+        """
+        values = self.embed_passages([record["text"] for record in batch])
+        return self.upsert_vectors(
+            namespace,
+            [
+                {
+                    "id": record["_id"],
+                    "values": vector,
+                    "metadata": {k: v for k, v in record.items() if k != "_id"}
                 }
-            )
-        self.index = pc.Index(index_name)
-        self.splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
+                for record, vector in zip(batch, values)
+            ]
+        )
+
+    def upsert_parallel(self , namespace : str , records , max_workers : int = 16 , upsert = None , record_overhead : int = 0):
+        """
+        Upserts records from any iterable in a producer/consumer pipeline. A
+        producer thread batches the records into a bounded queue while
+        max_workers consumer threads upsert them, so records are generated
+        while earlier batches are uploading and at most UPSERT_QUEUE_SIZE
+        batches are held in memory. Returns the number of records uploaded.
+        upsert defaults to upsert_batch, which embeds records server side.
+        record_overhead is passed to iter_batches.
+        """
+        upsert = upsert or self.upsert_batch
+        batches = queue.Queue(maxsize=UPSERT_QUEUE_SIZE)
+        errors = []
+        uploaded_records = []
+        # The record count is not known up front, so the bar counts batches without a total
+        progress = tqdm(desc=f"Upserting into {namespace}", unit="batch", mininterval=0.5)
 
-    def upload_prsdm_dataset(self):
+        def produce():
+            try:
+                for batch in self.iter_batches(records, record_overhead):
+                    if errors:
+                        break
+                    batches.put(batch)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for _ in range(max_workers):
+                    batches.put(None)
+
+        def consume():
+            while (batch := batches.get()) is not None:
+                # Keep draining after a failure so the producer never blocks on a full queue
+                if errors:
+                    continue
+                try:
+                    uploaded = upsert(namespace, batch)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                uploaded_records.append(uploaded)
+                progress.update(1)
+
+        threads = [threading.Thread(target=produce, daemon=True)]
+        threads += [threading.Thread(target=consume, daemon=True) for _ in range(max_workers)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            progress.close()
+            # Cached search results may no longer reflect the index
+            self.clear_search_cache()
+
+        if errors:
+            raise errors[0]
+        return sum(uploaded_records)
+
+    def iter_prsdm_records(self , dataset):
+        """
+        Yields one upsert record per Q&A chunk of the dataset. Rows are read
+        from the Arrow table in batches instead of materializing whole columns,
+        and each batch is split with a single splitter call.
+        """
+        idx = 0
+        for batch in dataset.iter(batch_size=1024):
+            questions = batch["Question"]
+            combined = [f"Q: {q}\nA: {a}" for q, a in zip(questions, batch["Answer"])]
+
+            for q, chunks in zip(questions, self.split_qa_texts(combined)):
+                for j, chunk in enumerate(chunks):
+                    yield {
+                        "_id": f"qa-{idx}-chunk-{j}",
+                        "text": chunk,
+                        "category": "ml-qa",
+                        "question": q
+                    }
+                idx += 1
+
+    def upload_prsdm_dataset(self , max_workers : int = 16):
         """
         Loads PRSDM Machine Learning Q&A dataset from Hugging Face
         and uploads it into Pinecone as Q/A chunks.
+        Rows are chunked while earlier batches are being upserted, and each
+        batch is embedded in a single inference call before the vector upsert.
         """
         dataset = load_dataset("prsdm/Machine-Learning-QA-dataset", split="train")
-        df = pd.DataFrame(dataset)
 
-        batch_size = 95
         namespace = "rag-space"
-        records = []
-        for idx, row in df.iterrows():
-            q = row["Question"]
-            a = row["Answer"]
-            combined_text = f"Q: {q}\nA: {a}"
-
-            chunks = self.splitter.split_text(combined_text)
-            for j, chunk in enumerate(chunks):
-                record_id = f"qa-{idx}-chunk-{j}"
-                records.append({
-                    "_id": record_id,
-                    "text": chunk,
-                    "category": "ml-qa",
-                    "question": q
-                })
 
         # ---- Batch Upload ----
-        for i in range(0, len(records), batch_size):
-            batch = records[i:i + batch_size]
-            self.index.upsert_records(
-                namespace=namespace,
-                records=batch
-            )
-            print(f"✅ Uploaded batch {i // batch_size + 1} ({len(batch)} records)")
+        total = self.upsert_parallel(
+            namespace,
+            self.iter_prsdm_records(dataset),
+            max_workers,
+            upsert=self.upsert_vector_batch,
+            record_overhead=self.vector_overhead()
+        )
 
-        print(f"🎉 Done! Uploaded total {len(records)} chunks into namespace `{namespace}`")
+        print(f"🎉 Done! Uploaded total {total} chunks into namespace `{namespace}`")
 
 
-    def generate_page_content(self , file_path:str):
-        loader = PyPDFLoader(file_path)
-        docs = loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(docs)
-        return chunks
+    def iter_pdf_pages(self , file_path : str) -> Iterator[Document]:
+        """
+        Yields one Document per page with source, page and total_pages
+        metadata. Larger PDFs are parsed in parallel worker processes, each
+        extracting a contiguous page range, and pages are yielded in order as
+        soon as their range is done.
+        """
+        page_count = len(PdfReader(file_path).pages)
+        if page_count <= SEQUENTIAL_PDF_PAGES:
+            page_ranges = [_extract_pages(file_path, 0, page_count)]
+            yield from self._page_documents(file_path, page_count, [0], page_ranges)
+            return
 
-    def save_embeddings(self, file_path :str  , title : str , name : str ):
-        chunks  = self.generate_page_content(file_path)
-        records = []
-        for i , chunk in enumerate(chunks) :
-            records.append(
-                {
-                    "id" : f"{name}#{i}" ,
-                    "text" : chunk[i] ,
-                    "title" : title
-                }
+        workers = min(os.cpu_count() or 1, 6)
+        step = -(-page_count // workers)
+        starts = list(range(0, page_count, step))
+        # Spawned, since this runs next to the upsert threads and forking a threaded process can deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            page_ranges = executor.map(
+                _extract_pages,
+                [file_path] * len(starts),
+                starts,
+                [min(start + step, page_count) for start in starts]
             )
+            yield from self._page_documents(file_path, page_count, starts, page_ranges)
+
+    @staticmethod
+    def _page_documents(file_path : str , page_count : int , starts : list , page_ranges):
+        for start, texts in zip(starts, page_ranges):
+            for page, text in enumerate(texts, start):
+                yield Document(
+                    page_content=text,
+                    metadata={"source": file_path, "page": page, "total_pages": page_count}
+                )
+
+    def iter_page_content(self , file_path : str) -> Iterator[Document]:
+        """Yields the chunks of a PDF page by page, without holding the whole document."""
+        for doc in self.iter_pdf_pages(file_path):
+            yield from self._page_splitter.split_documents([doc])
+
+    def save_embeddings(self, file_path :str  , title : str , name : str ):
+        chunks  = self.iter_page_content(file_path)
+        # Lazy, so the first batches are upserted while later pages are still being parsed
+        records = (
+            {"id" : f"{name}#{i}" , "text" : chunk.page_content , "title" : title}
+            for i , chunk in enumerate(chunks)
+        )
 
         try :
-            self.index.upsert_records(
-                "rag_space",
-                records = records
-            )
+            self.upsert_parallel("rag-space", records)
             return "User Date is Uploaded"
         except Exception as e:  # Catching a general exception
             print(f"An unexpected error occurred: {e}")
 
 
     def compare_embeddings(self , user_prompt :str):
-        namespace = "rag-space"
-        filtered_results = self.index.search(
-            namespace= namespace,
-            query= {
-                "top_k" : 3 ,
-                "inputs": {"text": user_prompt}
-            }
-        )
-        results_list = filtered_results['result']['hits']
-        final_list = []
-        for results in results_list:
-            doc = Document(page_content=results['fields']['text'])
-            final_list.append(doc)
-        return final_list
+        # Documents are mutable, so the cache holds the hit texts and fresh Documents are built per call
+        return [Document(page_content=text) for text in _search_index(self.index, user_prompt)]
+
+    def compare_embeddings_batch(self , user_prompts : list):
+        """Searches several prompts concurrently and returns one Document list per prompt."""
+        if not user_prompts:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(user_prompts), 16)) as executor:
+            return list(executor.map(self.compare_embeddings, user_prompts))
 
+    def clear_search_cache(self):
+        # The cache is shared by every handler in the process, so this clears all of it
+        _search_index.cache_clear()
+
+    def embed_query(self , user_prompt : str):
+        embeddings = self.pc.inference.embed(
+            model=EMBED_MODEL,
+            inputs=[user_prompt],
+            parameters={"input_type": "query"}
+        )
+        return embeddings[0]["values"]
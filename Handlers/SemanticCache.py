@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Caches flow results keyed by question embedding. A lookup returns the stored
+    result of the most similar previous question when the cosine similarity is
+    above the threshold. Entries expire after ttl seconds and the least recently
+    used entry is evicted once maxsize is reached. Lookups and writes are
+    guarded by a lock since flows are shared across sessions.
+    """
+
+    def __init__(self , embed_fn , threshold : float = 0.92 , maxsize : int = 256 , ttl : float = 3600):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._ids = count()
+        self._matrix = None
+        self._row_ids = []
+        self._lock = threading.Lock()
+
+    def embed(self , question : str):
+        vector = np.asarray(self.embed_fn(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self , vector):
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._matrix = np.stack([self._entries[i][0] for i in self._row_ids])
+
+            scores = self._matrix @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+
+            entry_id = self._row_ids[best]
+            self._entries.move_to_end(entry_id)
+            return self._entries[entry_id][1]
+
+    def put(self , vector , result : dict):
+        with self._lock:
+            self._entries[next(self._ids)] = (vector, result, time.monotonic())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._reset_matrix()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._reset_matrix()
+
+    # Callers hold self._lock
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        expired = [i for i, (_, _, created) in self._entries.items() if created < cutoff]
+        for i in expired:
+            del self._entries[i]
+        if expired:
+            self._reset_matrix()
+
+    def _reset_matrix(self):
+        self._matrix = None
+        self._row_ids = list(self._entries)
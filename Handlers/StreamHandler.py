@@ -0,0 +1,34 @@
+# Yielded before a new answer replaces the text already streamed, callers should discard what they have shown
+STREAM_RESET = "\x00STREAM_RESET\x00"
+
+
+def stream_generation(graph , inputs : dict , config : dict = None , token_nodes : tuple = ("generate",)):
+    """
+    Streams a flow's answer. LLM tokens from token_nodes are yielded as they
+    are produced. A node update whose generation differs from the streamed
+    tokens, such as a fallback answer or one from a node that does not
+    stream, is yielded whole. STREAM_RESET is yielded before any answer that
+    replaces one already yielded, e.g. when the graders send the flow back to
+    generate.
+    """
+    tokens = []
+    answered = False
+    for mode, chunk in graph.stream(inputs, config, stream_mode=["messages", "updates"]):
+        if mode == "messages":
+            message, metadata = chunk
+            if metadata.get("langgraph_node") in token_nodes and isinstance(message.content, str) and message.content:
+                if answered and not tokens:
+                    yield STREAM_RESET
+                tokens.append(message.content)
+                yield message.content
+            continue
+
+        for update in chunk.values():
+            if not isinstance(update, dict) or "generation" not in update:
+                continue
+            generation = update["generation"]
+            if "".join(tokens) != generation:
+                if answered or tokens:
+                    yield STREAM_RESET
+                yield generation
+            tokens, answered = [], True
@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from langchain_community.tools import TavilySearchResults
+from langchain_core.documents import Document
+
+_RESULT_TTL = 600
+_RESULT_MAXSIZE = 256
+_results = OrderedDict()
+_results_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is skipped because the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service after fail_max consecutive failures. Calls
+    fail fast with CircuitOpenError until reset_timeout seconds have passed,
+    then one trial call is let through.
+    """
+
+    def __init__(self , fail_max : int = 3 , reset_timeout : float = 30):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def call(self , fn , *args , **kwargs):
+        trial = False
+        with self._lock:
+            if self._opened_at is not None:
+                if self._trial_in_flight or time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError("circuit open, skipping call")
+                # Half open: only this caller goes through, the rest keep failing fast until it returns
+                self._trial_in_flight = True
+                trial = True
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._failures += 1
+                if trial or self._failures >= self.fail_max:
+                    self._opened_at = time.monotonic()
+                if trial:
+                    self._trial_in_flight = False
+            raise
+
+        with self._lock:
+            self._failures = 0
+            if trial:
+                self._opened_at = None
+                self._trial_in_flight = False
+        return result
+
+
+_breaker = CircuitBreaker()
+
+
+@lru_cache(maxsize=None)
+def get_web_search_tool(k : int = 3) -> TavilySearchResults:
+    """Returns a Tavily search tool shared by every flow in the process."""
+    return TavilySearchResults(k=k)
+
+
+def _search(query : str):
+    docs = get_web_search_tool().invoke({"query": query})
+    # The Tavily tool reports failures as a string instead of raising
+    if isinstance(docs, str):
+        raise RuntimeError(docs)
+    return docs
+
+
+def run_web_search(query : str , cache_key : str = None):
+    """
+    Runs a Tavily search behind the shared circuit breaker. Results are reused
+    for repeated cache_key values within _RESULT_TTL seconds. Flows pass the
+    user's original question as cache_key, since the LLM rewrite of it that
+    is searched for rarely comes out the same twice.
+    """
+    key = cache_key or query
+    with _results_lock:
+        cached = _results.get(key)
+        if cached is not None and time.monotonic() - cached[1] < _RESULT_TTL:
+            _results.move_to_end(key)
+            return cached[0]
+
+    docs = _breaker.call(_search, query)
+
+    with _results_lock:
+        _results[key] = (docs, time.monotonic())
+        _results.move_to_end(key)
+        while len(_results) > _RESULT_MAXSIZE:
+            _results.popitem(last=False)
+    return docs
+
+
+def docs_to_document(docs, key : str = "content") -> Document:
+    """Joins web search results into a single Document."""
+    return Document(page_content="\n".join(d[key] for d in docs))
@@ -0,0 +1,22 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+
+class DocumentGrade(BaseModel):
+    """Binary score for relevance check on one numbered document."""
+
+    index: int = Field(
+        description="Number of the graded document, as shown in brackets"
+    )
+    binary_score: str = Field(
+        description="Document is relevant to the question, 'yes' or 'no'"
+    )
+
+
+class GradeDocumentsBatch(BaseModel):
+    """Binary scores for relevance check on a numbered list of retrieved documents."""
+
+    grades: List[DocumentGrade] = Field(
+        description="One grade for every numbered document"
+    )
@@ -1,10 +0,0 @@
-from typing import Literal
-from pydantic import BaseModel, Field
-
-class RouteQuery(BaseModel):
-    """Route a user query to the most relevant datasource."""
-
-    datasource: Literal["self-flow", "web_search"] = Field(
-        ...,
-        description="Given a user question choose to route it to web search or a vectorstore.",
-    )
@@ -0,0 +1,14 @@
+from typing import Literal
+from pydantic import BaseModel, Field
+
+class RouteQueryWithConfidence(BaseModel):
+    """Route a user query to the most relevant datasource and rate the routing confidence."""
+
+    datasource: Literal["self-flow", "web_search"] = Field(
+        ...,
+        description="Given a user question choose to route it to web search or a vectorstore.",
+    )
+    confidence: float = Field(
+        ...,
+        description="Probability between 0 and 1 that the chosen datasource is the right one.",
+    )
@@ -1,11 +1,15 @@
-from typing_extensions import TypedDict
-
-
-class AdaptiveState(TypedDict):
-    question : str
-    generation : str
-    documents : list[str]
-
+from dataclasses import dataclass
 
+from langchain_core.documents import Document
 
 
+@dataclass(slots=True)
+class AdaptiveState:
+    question : str = ""
+    # The question as asked, before any rewrite
+    original_question : str = ""
+    generation : str = ""
+    documents : tuple[Document, ...] = ()
+    retry_count : int = 0
+    # False when the generation is a fallback or was not graded, so it must not be cached
+    cacheable : bool = True
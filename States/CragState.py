@@ -1,11 +1,15 @@
-from typing import List
+from dataclasses import dataclass
+from typing import Tuple
 
-from typing_extensions import TypedDict
+from langchain_core.documents import Document
 
 
-class CragState(TypedDict):
+@dataclass(slots=True)
+class CragState:
 
-    question: str
-    generation: str
-    web_search: str
-    documents: List[str]
\ No newline at end of file
+    question: str = ""
+    # The question as asked, before any rewrite
+    original_question: str = ""
+    generation: str = ""
+    web_search: str = ""
+    documents: Tuple[Document, ...] = ()
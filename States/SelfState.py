@@ -1,8 +1,14 @@
-from typing import List
-from typing_extensions import TypedDict
+from dataclasses import dataclass
+from typing import Tuple
 
-class SelfState(TypedDict):
-    retry_count : int
-    question: str
-    generation: str
-    documents: List[str]
\ No newline at end of file
+from langchain_core.documents import Document
+
+
+@dataclass(slots=True)
+class SelfState:
+    retry_count : int = 0
+    question: str = ""
+    generation: str = ""
+    documents: Tuple[Document, ...] = ()
+    # False when the generation is a fallback or was not graded, so it must not be cached
+    cacheable: bool = True